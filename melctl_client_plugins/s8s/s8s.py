@@ -35,10 +35,30 @@ __copyright__  = 'Copyright (c) 2023 LuxProvide S.A.'
 __maintainer__ = 'Jean-Philippe Clipffel'
 
 
+import os
 import re
 import sys
+import stat
 import json
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+
+    def _json_loads(data: bytes):
+        return orjson.loads(data)
+
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    def _json_loads(data: bytes):
+        return json.loads(data)
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, indent=2).encode()
 
 from melctl_client.commands import Command, SimpleCommand
 from melctl_client.config import settings
@@ -47,6 +67,40 @@ from melctl_client.config import settings
 cfgfile = Path(settings.Config.secrets_dir, 's8s_config.json')
 
 
+def _load_config() -> dict:
+    """Loads the S8S configurations file.
+    """
+    with open(cfgfile, 'rb') as fd:
+        return _json_loads(fd.read())
+
+
+def _write_config(config: dict):
+    """Writes the S8S configurations file.
+
+    The file is left untouched if its content would not change, and is
+    otherwise replaced atomically.
+
+    :param config: Configurations to write
+    """
+    data = _json_dumps(config)
+    if cfgfile.exists() and cfgfile.read_bytes() == data:
+        return
+    tmpfile = cfgfile.with_suffix('.json.tmp')
+    try:
+        # Keep the file private as it holds join tokens
+        fdesc = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fdesc, 'wb') as fd:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        if cfgfile.exists():
+            os.chmod(tmpfile, stat.S_IMODE(cfgfile.stat().st_mode))
+        os.replace(tmpfile, cfgfile)
+    finally:
+        if tmpfile.exists():
+            tmpfile.unlink()
+
+
 
 
 class _S8SCommand:
@@ -84,8 +138,7 @@ class _S8SCommand:
             if cfgfile.exists():
                 # Load configuration
                 try:
-                    with open(cfgfile, 'r') as fd:
-                        config = json.load(fd)[args.config]
+                    config = _load_config()[args.config]
                 except KeyError:
                     raise Exception(f'S8S configuration "{args.config}" is not defined')
                 # Patch arguments
@@ -150,8 +203,7 @@ class SetConfig(Command):
     def target(self, args):
         # Load S8S configuration
         if cfgfile.exists():
-            with open(cfgfile, 'r') as fd:
-                config = json.load(fd)
+            config = _load_config()
         else:
             config = {}
         # Setup configuration
@@ -162,8 +214,7 @@ class SetConfig(Command):
             'token': args.token
         }
         # Write configuration
-        with open(cfgfile, 'w') as fd:
-            json.dump(config, fd, indent=2)
+        _write_config(config)
         # Done
         return {
             'file': str(cfgfile),
@@ -187,8 +238,7 @@ class GetConfig(Command):
         if not cfgfile.exists():
             return []
         try:
-            with open(cfgfile, 'r') as fd:
-                config = json.load(fd)
+            config = _load_config()
             # Select config
             if args.name is not None:
                 config = {args.name: config[args.name]}
@@ -220,12 +270,10 @@ class DelConfig(Command):
     def target(self, args):
         if not cfgfile.exists():
             return {}
-        with open(cfgfile, 'r') as fd:
-            config = json.load(fd)
-            if args.name in config:
-                del config[args.name]
-        with open(cfgfile, 'w') as fd:
-            json.dump(config, fd, indent=2)
+        config = _load_config()
+        if args.name in config:
+            del config[args.name]
+            _write_config(config)
         return {
             'deleted': args.name
         }
@@ -325,6 +373,7 @@ class Scale(Command):
     """
 
     partitions = ('cpu', 'gpu', 'mem', 'fpga')
+    max_workers = 16
     regex_scalespecs = re.compile(r'^(?P<nodes>[0-9]+):(?P<time>[0-9]+)$')
 
     @classmethod
@@ -336,12 +385,12 @@ class Scale(Command):
 
     @classmethod
     def end_with_usage(cls, msgs: list[str]):
-        for msg in msgs:
-            print(msg.format(
-                melctl=f'{Path(sys.argv[0]).parts[-1]}',
-                cmd=f'{Path(sys.argv[0]).parts[-1]} {sys.argv[1]} {sys.argv[2]}'
-            ),
-            file=sys.stderr)
+        melctl = Path(sys.argv[0]).parts[-1]
+        cmd = f'{melctl} {sys.argv[1]} {sys.argv[2]}'
+        sys.stderr.write('\n'.join(
+            msg.format(melctl=melctl, cmd=cmd)
+            for msg in msgs
+        ) + '\n')
         sys.exit(1)
 
     def __init__(self, subparser):
@@ -358,6 +407,8 @@ class Scale(Command):
             help='Cluster join token')
         self.parser.add_argument('--dry-run', action='store_true', default=False,
             help='Dry run mode')
+        self.parser.add_argument('--batch', action='store_true', default=False,
+            help='Request all nodes in a single request (requires server support)')
         for p in self.partitions:
             self.parser.add_argument(f'--{p}', dest=f'specs_{p}',
                 type=Scale.type_scalespecs, default=[], action='append',
@@ -381,12 +432,11 @@ class Scale(Command):
                 ))
             # Load configuration
             try:
-                with open(cfgfile, 'r') as fd:
-                    cfg = json.load(fd)[args.name]
-                    args.region = cfg['region']
-                    args.pool = cfg['pool']
-                    args.master = cfg['master']
-                    args.token = cfg['token']
+                cfg = _load_config()[args.name]
+                args.region = cfg['region']
+                args.pool = cfg['pool']
+                args.master = cfg['master']
+                args.token = cfg['token']
             except Exception as error:
                 self.end_with_usage((
                     '{cmd}: error: configuration ' + args.name + ' not found or invalid',
@@ -400,6 +450,88 @@ class Scale(Command):
         # Done
         return args
 
+    @classmethod
+    def batch_rejected(cls, req) -> bool:
+        """Tells if a batch request failed because its list body was rejected.
+
+        Validation errors on the body as a whole (e.g. a list where an
+        object is expected) mean batching is not supported; errors on the
+        body fields (token, pool, etc.) are real errors.
+
+        :param req: Batch request response
+        """
+        if req.status_code == 415:
+            return True
+        if req.status_code not in (400, 422):
+            return False
+        try:
+            detail = req.json()['detail']
+        except Exception:
+            return False
+        if not isinstance(detail, list) or len(detail) < 1:
+            return False
+        return all(
+            isinstance(error, dict) and list(error.get('loc', [])) == ['body']
+            for error in detail
+        )
+
+    def resize_pool_adapter(self):
+        """Grows the session's connection pool for concurrent requests.
+
+        The adapter already mounted for the API URL is kept (with its
+        retries, TLS settings, etc.); only its pool manager is re-created
+        with a larger pool.
+        """
+        adapter = self.session.get_adapter(self.url)
+        if not isinstance(adapter, HTTPAdapter):
+            return
+        if getattr(adapter, '_pool_maxsize', 0) >= self.max_workers:
+            return
+        adapter.poolmanager.clear()
+        adapter.init_poolmanager(self.max_workers, self.max_workers,
+            block=getattr(adapter, '_pool_block', False))
+
+    def post_nodes(self, url: str, params: dict, scale_specs: list[dict]) -> list[dict]:
+        """Requests nodes with one request per node.
+
+        The first specification is posted alone so that request-wide errors
+        (token, quota, pool) fail fast; the remaining specifications are
+        then posted concurrently. If some of them fail, the error lists
+        both the nodes which were created and the failures.
+
+        :param url: Pool URL
+        :param params: Query parameters
+        :param scale_specs: Nodes specifications
+        """
+        # First node: fail fast
+        req = self.session.post(url, json=scale_specs[0], params=params)
+        self.raise_for_status(req)
+        stats = [req.json(), ]
+        if len(scale_specs) == 1:
+            return stats
+        # Remaining nodes: request them concurrently
+        errors = []
+        workers = min(self.max_workers, len(scale_specs) - 1)
+        self.resize_pool_adapter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self.session.post, url, json=node_specs, params=params)
+                for node_specs in scale_specs[1:]
+            ]
+            for future in futures:
+                try:
+                    req = future.result()
+                    self.raise_for_status(req)
+                    stats.append(req.json())
+                except Exception as error:
+                    errors.append(str(error))
+        if len(errors) > 0:
+            raise Exception(
+                f'{len(errors)} of {len(scale_specs)} node requests failed: '
+                f'{"; ".join(errors)}; created nodes: {json.dumps(stats)}'
+            )
+        return stats
+
     def target(self, args):
         args = self.reprocess_args(args)
         scale_specs = []
@@ -407,17 +539,20 @@ class Scale(Command):
         # Process nodes specifications
         for part in self.partitions:
             for part_specs in getattr(args, f'specs_{part}'):
-                for _ in range(int(part_specs['nodes'])):
-                    scale_specs.append({
-                        'region': args.region,
-                        'pool': args.pool,
-                        'features': {
-                            part: True
-                        },
-                        'seconds': int(part_specs['time']),
-                        'master': args.master,
-                        'token': args.token
-                    })
+                node_specs = {
+                    'region': args.region,
+                    'pool': args.pool,
+                    'features': {
+                        part: True
+                    },
+                    'seconds': int(part_specs['time']),
+                    'master': args.master,
+                    'token': args.token
+                }
+                scale_specs.extend(
+                    node_specs.copy()
+                    for _ in range(int(part_specs['nodes']))
+                )
         # Ensure nodes are requested
         if len(scale_specs) < 1:
             _parts = ', '.join([
@@ -430,15 +565,24 @@ class Scale(Command):
             )
             sys.exit(1)
         # Request nodes
-        for node_specs in scale_specs:
-            req = self.session.post(
-                f'{self.url}/s8s/regions/{args.region}/pools/{args.pool}',
-                json=node_specs,
-                params={
-                    'dry_run': args.dry_run
-                }
-            )
-            self.raise_for_status(req)
-            scale_stats.append(req.json())
+        url = f'{self.url}/s8s/regions/{args.region}/pools/{args.pool}'
+        params = {
+            'dry_run': args.dry_run
+        }
+        if args.batch and len(scale_specs) > 1:
+            # Request all nodes in a single batch
+            req = self.session.post(url, json=scale_specs, params=params)
+            if self.batch_rejected(req):
+                # Batch not supported: fallback to per-node requests
+                scale_stats.extend(self.post_nodes(url, params, scale_specs))
+            else:
+                self.raise_for_status(req)
+                body = req.json()
+                if isinstance(body, list):
+                    scale_stats.extend(body)
+                else:
+                    scale_stats.append(body)
+        else:
+            scale_stats.extend(self.post_nodes(url, params, scale_specs))
         # Done
         return scale_stats
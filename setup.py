@@ -89,7 +89,13 @@ setup(
         'melctl_client >= 5.2.0, < 6.0.0',
         'aiofiles >= 22.1',
         'aiobotocore >= 2.4',
+        'requests >= 2.25',
         # Library stubs
         'types-aiofiles >= 22.1',
-    ]
+    ],
+    extras_require={
+        'fast': [
+            'orjson >= 3',
+        ]
+    }
 )